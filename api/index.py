@@ -55,6 +55,7 @@ class JobStatus(BaseModel):
     status: str
     message: Optional[str] = None
     video_url: Optional[str] = None
+    progress: Optional[int] = None
 
 @app.post("/analyze", response_model=AnalyzeResponse)
 async def analyze_story(story_text: str = Form(...)):
@@ -143,18 +144,31 @@ def background_video_task(
 
         voice_file = job_data.get("voice_file")
         if not voice_file:
-            print(f"Job {job_id}: No voice uploaded, generating gTTS fallback...")
-            voice_file = generate_voice_fallback(full_text, voice_gender, job_id)
+            print(f"Job {job_id}: No voice uploaded, generating TTS fallback...")
+            voice_file = generate_voice_fallback(full_text, voice_gender, job_id, scene_texts_for_caption)
             if not voice_file or not os.path.exists(voice_file):
                 raise Exception("Voice file not provided and fallback generation failed.")
             job_data["voice_file"] = voice_file
         
+        # Segments map to 0-90% and the final mux to 90-100%, so the
+        # reported progress never goes backwards between stages.
+        def report_progress(stage: str, done: int, total: int):
+            if total:
+                fraction = min(1.0, done / total)
+                if stage == "final":
+                    percent = 90 + int(10 * fraction)
+                else:
+                    percent = int(90 * fraction)
+                job_data["progress"] = max(job_data.get("progress") or 0, percent)
+                job_data["message"] = f"Rendering ({stage})"
+
         final_video_path = create_video_from_prompts(
             prompt_image_map=map_images_by_prompt_number(image_files),
             voice_file_path=voice_file,
             job_id=job_id,
             target_duration_minutes=target_duration,
-            scene_texts_for_caption=scene_texts_for_caption
+            scene_texts_for_caption=scene_texts_for_caption,
+            progress_callback=report_progress
         )
         
         if not final_video_path or not os.path.exists(final_video_path):
@@ -162,6 +176,8 @@ def background_video_task(
 
         video_url = f"/download_video/{job_id}"
         job_data["status"] = "completed"
+        job_data["progress"] = 100
+        job_data["message"] = None
         job_data["video_url"] = video_url
         job_data["final_path"] = final_video_path
         
@@ -212,7 +228,8 @@ async def get_job_status(job_id: str):
         job_id=job_id,
         status=job.get("status", "unknown"),
         message=job.get("message"),
-        video_url=job.get("video_url")
+        video_url=job.get("video_url"),
+        progress=job.get("progress")
     )
 
 @app.get("/download_video/{job_id}")
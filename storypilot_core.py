@@ -1,38 +1,117 @@
 # storypilot_core.py (FINAL, STABLE VERSION)
 
 import os
-import re
+import asyncio
 import uuid
 import json
-import math
+import shutil
 import subprocess
-from collections import defaultdict
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+from operator import itemgetter
 from dataclasses import dataclass, field
-from typing import List, Dict, Optional
+from typing import Callable, List, Dict, Optional
 from textwrap import wrap
 
 from gtts import gTTS # Pro Voice Fix
+from PIL import Image, ImageDraw, ImageFont
 
 # --- Folder Configuration ---
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 UPLOADS_DIR = os.path.join(BASE_DIR, "uploads")
 OUTPUT_DIR = os.path.join(BASE_DIR, "output")
 
+# Intermediate segments go to a RAM disk when one is available and has
+# room for the job (Docker's default /dev/shm is only 64 MB). The estimate
+# is an upper bound: segment bitrate for 1080p ultrafast/stillimage x264,
+# plus the pre-scaled PNG and caption for each image.
+SCRATCH_RAMDISK = "/dev/shm"
+SCRATCH_SEGMENT_BITRATE = 50_000_000  # bits per second
+SCRATCH_BYTES_PER_IMAGE = 16 * 1024 * 1024
+SCRATCH_HEADROOM = 1.5
+
+# --- Precomputed tables ---
+_NEWLINE_TO_PERIOD = str.maketrans('\n', '.')
+_SEP_BYTES = os.fsencode(os.sep)
+
 # --- FFMPEG Path (Local PC) ---
 FFMPEG_PATH = os.path.join(BASE_DIR, "ffmpeg.exe")
 if not os.path.exists(FFMPEG_PATH):
     FFMPEG_PATH = "ffmpeg" 
 
+# --- Video Encoder (hardware if available) ---
+VAAPI_DEVICE = "/dev/dri/renderD128"
+_HW_ENCODERS = ["h264_nvenc", "h264_qsv", "h264_vaapi"]
+
+def _detect_video_encoder() -> str:
+    """
+    Returns the first hardware H.264 encoder that FFmpeg lists and that can
+    actually open a test frame on this machine, else 'libx264'.
+    """
+    try:
+        result = subprocess.run(
+            [FFMPEG_PATH, '-hide_banner', '-encoders'],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, check=True
+        )
+    except Exception:
+        return "libx264"
+
+    for encoder in _HW_ENCODERS:
+        if encoder not in result.stdout:
+            continue
+        # Builds often list encoders for hardware that isn't present.
+        cmd = [FFMPEG_PATH, '-hide_banner']
+        vf = 'format=nv12'
+        if encoder == "h264_vaapi":
+            if not os.path.exists(VAAPI_DEVICE):
+                continue
+            cmd += ['-vaapi_device', VAAPI_DEVICE]
+            vf += ',hwupload'
+        cmd += [
+            '-f', 'lavfi', '-i', 'color=black:s=256x256:d=0.1',
+            '-vf', vf, '-frames:v', '1', '-c:v', encoder, '-f', 'null', '-'
+        ]
+        try:
+            subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=15)
+            return encoder
+        except Exception:
+            continue
+
+    return "libx264"
+
+HWENC = _detect_video_encoder()
+print(f"Video encoder: {HWENC}")
+
+# --- Local TTS (Piper) ---
+# Used for the voice fallback when available; otherwise we fall back to gTTS.
+PIPER_PATH = os.path.join(BASE_DIR, "piper.exe")
+if not os.path.exists(PIPER_PATH):
+    PIPER_PATH = shutil.which("piper") or ""
+PIPER_MODEL = os.environ.get("PIPER_MODEL", os.path.join(BASE_DIR, "en_US-lessac-medium.onnx"))
+
 # --- Font file for captions ---
 FONT_FILE = os.path.join(BASE_DIR, "BebasNeue-Regular.ttf")
 if not os.path.exists(FONT_FILE):
     print("WARNING: Font file 'BebasNeue-Regular.ttf' not found. Using default.")
     FONT_FILE = "Arial.ttf" # Fallback font
 
-os.makedirs(UPLOADS_DIR, exist_ok=True)
-os.makedirs(OUTPUT_DIR, exist_ok=True)
-os.makedirs(os.path.join(UPLOADS_DIR, "images"), exist_ok=True)
-os.makedirs(os.path.join(UPLOADS_DIR, "audio"), exist_ok=True)
+_DIRS_INITIALIZED = False
+
+def _ensure_dirs() -> None:
+    """
+    Creates the working folders once per process. Only the leaf folders are
+    listed; makedirs creates UPLOADS_DIR on the way.
+    """
+    global _DIRS_INITIALIZED
+    if _DIRS_INITIALIZED:
+        return
+    for path in (os.path.join(UPLOADS_DIR, "images"), os.path.join(UPLOADS_DIR, "audio"), OUTPUT_DIR):
+        os.makedirs(path, exist_ok=True)
+    _DIRS_INITIALIZED = True
+
+_ensure_dirs()
 
 
 @dataclass
@@ -52,7 +131,9 @@ def generate_prompts_from_story(story_text: str) -> AnalysisResult:
     Simple prompt generator. Splits story by newline or period.
     """
     print("Using standard prompt generator (non-Gemini).")
-    scenes = [s.strip() for s in re.split(r'[\n\.]+', story_text) if s.strip() and len(s) > 5]
+    # Newlines become periods, so a single split covers both delimiters;
+    # the empty pieces from runs like ".\n" fail the length check.
+    scenes = [s.strip() for s in story_text.translate(_NEWLINE_TO_PERIOD).split('.') if len(s) > 5 and s.strip()]
     if not scenes: scenes = [story_text] if story_text.strip() else []
     
     prompts = []
@@ -71,28 +152,134 @@ def generate_prompts_from_story(story_text: str) -> AnalysisResult:
         scene_count=len(scenes)
     )
 
-def map_images_by_prompt_number(image_files: List[str]) -> Dict[int, List[str]]:
-    prompt_map = defaultdict(list)
-    filename_regex = re.compile(r"^(\d+)") 
-    
-    for img_path in image_files:
-        filename = os.path.basename(img_path)
-        match = filename_regex.match(filename)
-        
-        if match:
-            file_number = int(match.group(1))
-            prompt_number = math.ceil(file_number / 2)
-            prompt_map[prompt_number].append(img_path)
+def _leading_num_unicode(name: str) -> int:
+    """Slow path for non-ASCII names: any Unicode decimal digits, like int()."""
+    k = 0
+    while k < len(name) and name[k].isdecimal():
+        k += 1
+    return int(name[:k]) if k else -1
+
+def _leading_num(name: bytes) -> int:
+    """Parses the leading decimal digits of a filename; -1 if there are none."""
+    n = -1
+    for c in name:
+        if 48 <= c <= 57:
+            n = (0 if n < 0 else n * 10) + (c - 48)
+        elif c >= 0x80:
+            # Possibly a non-ASCII digit (e.g. Bengali or fullwidth).
+            return _leading_num_unicode(os.fsdecode(name))
         else:
-            print(f"Warning: Skipping file (no leading number): {filename}")
+            break
+    return n
+
+def _filename_bytes(path: str) -> bytes:
+    """Last path segment as bytes (handles both '/' and the OS separator)."""
+    raw = os.fsencode(path)
+    cut = max(raw.rfind(b'/'), raw.rfind(_SEP_BYTES))
+    return raw[cut + 1:]
+
+def map_images_by_prompt_number(image_files: List[str]) -> Dict[int, List[str]]:
+    # Two images per prompt: files 1,2 -> prompt 1; 3,4 -> prompt 2; ...
+    pairs = [
+        ((n + 1) >> 1, p)
+        for p in image_files
+        if (n := _leading_num(_filename_bytes(p))) >= 0
+    ]
+
+    if len(pairs) != len(image_files):
+        for img_path in image_files:
+            if _leading_num(_filename_bytes(img_path)) < 0:
+                print(f"Warning: Skipping file (no leading number): {os.path.basename(img_path)}")
+
+    # Stable sort keeps upload order within each prompt.
+    pairs.sort(key=itemgetter(0))
+    return {k: [p for _, p in g] for k, g in groupby(pairs, key=itemgetter(0))}
+
+def _half_cores(n: int) -> int:
+    """
+    Worker count for n parallel FFmpeg/Piper jobs: at most half the cores,
+    so each child process still gets threads of its own.
+    """
+    return min(n, max(1, (os.cpu_count() or 2) // 2))
+
+def _piper_available() -> bool:
+    return bool(PIPER_PATH) and os.path.exists(PIPER_MODEL)
+
+def _synthesize_piper(text: str, output_path: str) -> str:
+    """Runs Piper locally, writing a WAV file. Returns the path."""
+    cmd = [PIPER_PATH, '--model', PIPER_MODEL, '--output_file', output_path]
+    subprocess.run(cmd, input=text.encode('utf-8'), check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return output_path
+
+def _generate_voice_piper(text: str, job_id: str, scene_texts: Optional[List[str]] = None) -> str:
+    """
+    Local TTS using Piper. When the text is exactly the joined scenes, each
+    scene is synthesized in parallel and the WAVs are concatenated.
+    """
+    audio_dir = os.path.join(UPLOADS_DIR, "audio")
+    output_path = os.path.join(audio_dir, f"voice_{job_id}.wav")
+
+    if not scene_texts or len(scene_texts) < 2 or ". ".join(scene_texts) != text:
+        return _synthesize_piper(text, output_path)
 
-    sorted_map = dict(sorted(prompt_map.items()))
-    return sorted_map
+    part_paths = [os.path.join(audio_dir, f"voice_{job_id}_{k}.wav") for k in range(len(scene_texts))]
+    part_list_file = os.path.join(audio_dir, f"voice_{job_id}_parts.txt")
+    try:
+        with ThreadPoolExecutor(max_workers=_half_cores(len(scene_texts))) as executor:
+            list(executor.map(_synthesize_piper, scene_texts, part_paths))
+
+        with open(part_list_file, 'w') as f:
+            for path in part_paths:
+                f.write(f"file '{os.path.abspath(path).replace(os.sep, '/')}'\n")
 
-def generate_voice_fallback(text: str, gender: str, job_id: str) -> str:
+        cmd_concat = [
+            FFMPEG_PATH, '-y',
+            '-f', 'concat',
+            '-safe', '0',
+            '-i', part_list_file,
+            '-c', 'copy',
+            output_path
+        ]
+        subprocess.run(cmd_concat, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    finally:
+        # Each file on its own, so one failure doesn't leave the rest behind.
+        for path in [part_list_file, *part_paths]:
+            try:
+                if os.path.exists(path):
+                    os.remove(path)
+            except Exception as e:
+                print(f"Warning: Could not clean up voice part {path}: {e}")
+
+    return output_path
+
+def generate_voice_fallback(
+    text: str,
+    gender: str,
+    job_id: str,
+    scene_texts: Optional[List[str]] = None,
+    backend: str = "auto"
+) -> str:
     """
-    Fallback TTS using gTTS (Google Translate's voice) - much better quality.
+    Fallback TTS. Uses local Piper when installed (no network round-trip),
+    otherwise gTTS (Google Translate's voice).
+    backend: "auto" (Piper, then gTTS), "piper" (Piper only) or "gtts".
+    Returns "" on failure.
     """
+    if backend == "piper" and not _piper_available():
+        print("Error: Piper backend requested but Piper or its model is not installed.")
+        return ""
+
+    if backend in ("auto", "piper") and _piper_available():
+        try:
+            output_path = _generate_voice_piper(text, job_id, scene_texts)
+            print(f"Piper voice generated successfully at {output_path}")
+            return output_path
+        except Exception as e:
+            if backend == "piper":
+                print(f"Error during Piper generation: {e}")
+                return ""
+            print(f"Error during Piper generation, falling back to gTTS: {e}")
+
     try:
         output_filename = f"voice_{job_id}.mp3"
         output_path = os.path.join(UPLOADS_DIR, "audio", output_filename)
@@ -107,7 +294,21 @@ def generate_voice_fallback(text: str, gender: str, job_id: str) -> str:
         return ""
 
 def get_audio_duration(file_path: str) -> float:
-    """Gets the audio file duration in seconds using ffprobe."""
+    """
+    Gets the audio file duration in seconds using ffprobe.
+    The result is cached in a '<file>.meta.json' sidecar keyed on mtime.
+    """
+    sidecar = file_path + ".meta.json"
+    try:
+        mtime = os.path.getmtime(file_path)
+        if os.path.exists(sidecar):
+            with open(sidecar, 'r') as f:
+                meta = json.load(f)
+            if meta.get("mtime") == mtime:
+                return float(meta["duration"])
+    except Exception as e:
+        print(f"Warning: Ignoring audio metadata cache for {file_path}: {e}")
+
     try:
         ffprobe_path = FFMPEG_PATH.replace("ffmpeg.exe", "ffprobe.exe")
         if "ffprobe" not in ffprobe_path:
@@ -118,20 +319,324 @@ def get_audio_duration(file_path: str) -> float:
             "-of", "default=noprint_wrappers=1:nokey=1", file_path
         ]
         result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True)
-        return float(result.stdout.strip())
+        duration = float(result.stdout.strip())
     except Exception as e:
         print(f"Error getting audio duration (is ffprobe installed?): {e}")
         return 0.0
 
+    try:
+        with open(sidecar, 'w') as f:
+            json.dump({"duration": duration, "mtime": os.path.getmtime(file_path)}, f)
+    except Exception as e:
+        print(f"Warning: Could not write audio metadata cache: {e}")
+
+    return duration
+
+def _prescale_image(path: str, scaled_path: str) -> str:
+    """
+    Writes a 1920x1080 letterboxed PNG of the image to scaled_path and
+    returns it. Falls back to the original path if scaling fails.
+    """
+    try:
+        cmd = [
+            FFMPEG_PATH, '-y',
+            '-i', path,
+            '-vf', "scale=1920:1080:force_original_aspect_ratio=decrease,"
+                   "pad=1920:1080:(ow-iw)/2:(oh-ih)/2:color=black",
+            '-frames:v', '1',
+            scaled_path
+        ]
+        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return scaled_path
+    except Exception as e:
+        print(f"Warning: Could not pre-scale {path}, using original: {e}")
+        return path
+
+def _render_caption_png(wrapped_text: str, font_file: str, caption_path: str) -> str:
+    """
+    Renders the caption (white text on a 50% black box) to a transparent PNG
+    at caption_path. Returns "" for empty captions.
+    """
+    if not wrapped_text.strip():
+        return ""
+
+    try:
+        font = ImageFont.truetype(font_file, 60)
+    except OSError:
+        font = ImageFont.load_default(size=60)
+
+    border = 10
+    measure = ImageDraw.Draw(Image.new("RGBA", (1, 1)))
+    left, top, right, bottom = measure.multiline_textbbox((0, 0), wrapped_text, font=font)
+    width = (right - left) + 2 * border
+    height = (bottom - top) + 2 * border
+
+    canvas = Image.new("RGBA", (width, height), (0, 0, 0, 128))
+    draw = ImageDraw.Draw(canvas)
+    draw.multiline_text((border - left, border - top), wrapped_text, font=font, fill=(255, 255, 255, 255))
+
+    canvas.save(caption_path)
+    return caption_path
+
+def _zoompan_filter(effect_cycle: int, num_frames: int, fps: int) -> str:
+    """
+    Builds the zoompan filter for one of the three zoom/pan effects.
+    zoompan emits all num_frames output frames from a single input frame,
+    so the image is decoded once per segment.
+    """
+    if effect_cycle == 0: # Zoom In (Focus Center)
+        zoom_dir = "min(1.5,zoom+0.0025)"
+        pan_x = "iw/2-(iw/zoom/2)"
+        pan_y = "ih/2-(ih/zoom/2)"
+    elif effect_cycle == 1: # Zoom Out (Focus Center)
+        zoom_dir = f"max(1.0, 1.4 - 0.4*on/{num_frames})"
+        pan_x = "iw/2-(iw/zoom/2)"
+        pan_y = "ih/2-(ih/zoom/2)"
+    else: # Pan Left to Right (Stable Zoom)
+        zoom_dir = "1.1" # Fixed slight zoom
+        pan_x = f"if(eq(on,0), 0, x+((iw/zoom)/{num_frames}/2))"
+        pan_y = "y"
+
+    return (
+        f"zoompan=z='{zoom_dir}':x='{pan_x}':y='{pan_y}':"
+        f"d={num_frames}:s=1920x1080:fps={fps}"
+    )
+
+def _build_segment_cmd(args) -> List[str]:
+    """Builds the FFmpeg command for a single still-image segment."""
+    img_path, segment_path, num_frames, vf_complex, caption_png, fps = args
+
+    # A single frame of the image is read; zoompan generates the rest.
+    # Caption PNG (if any) is alpha-blended over the zoom/pan output.
+    inputs = ['-i', img_path]
+    if caption_png:
+        inputs += ['-i', caption_png]
+        filters = f"[0:v]{vf_complex}[bg];[bg][1:v]overlay=(W-w)/2:H-h-50"
+    else:
+        filters = f"[0:v]{vf_complex}"
+
+    pre_input = []
+    if HWENC == "h264_nvenc":
+        codec_args = ['-c:v', HWENC, '-preset', 'p4', '-tune', 'hq', '-pix_fmt', 'yuv420p']
+    elif HWENC == "h264_qsv":
+        codec_args = ['-c:v', HWENC, '-preset', 'veryfast', '-pix_fmt', 'nv12']
+    elif HWENC == "h264_vaapi":
+        # Frames are uploaded to the GPU after the CPU-side filters.
+        pre_input = ['-vaapi_device', VAAPI_DEVICE]
+        filters += ",format=nv12,hwupload"
+        codec_args = ['-c:v', HWENC]
+    else:
+        codec_args = ['-c:v', 'libx264', '-preset', 'ultrafast', '-tune', 'stillimage', '-pix_fmt', 'yuv420p']
+
+    cmd = [
+        FFMPEG_PATH, '-y',
+        *pre_input,
+        *inputs,
+        '-filter_complex', f"{filters}[v]",
+        '-map', '[v]',
+        *codec_args,
+        '-threads', '2',
+        # Fixed 1s GOP opening on an IDR frame, identical for every
+        # segment, so the concat stage can always stream-copy.
+        '-g', str(fps),
+        '-keyint_min', str(fps),
+        '-sc_threshold', '0',
+        '-force_key_frames', 'expr:eq(n,0)',
+        '-frames:v', str(num_frames),
+        '-r', str(fps),
+        segment_path
+    ]
+    return cmd
+
+def _with_progress(cmd: List[str]) -> List[str]:
+    """Adds FFmpeg's machine-readable progress output on stdout."""
+    return [cmd[0], '-progress', 'pipe:1', '-nostats', *cmd[1:]]
+
+def _parse_progress_value(line: str, key: str) -> Optional[int]:
+    """Returns the integer value of 'key' from a '-progress' line, or None."""
+    prefix = key + '='
+    if not line.startswith(prefix):
+        return None
+    try:
+        return int(line[len(prefix):])
+    except ValueError: # e.g. 'out_time_us=N/A' before the first packet
+        return None
+
+def _run_ffmpeg(
+    cmd: List[str],
+    timeout: float,
+    on_out_time: Optional[Callable[[int], None]] = None,
+    input_text: Optional[str] = None
+) -> None:
+    """
+    Runs FFmpeg with progress reporting on a pipe. Kills it if it runs past
+    'timeout' seconds, so a stuck input can't block the job forever.
+    on_out_time gets the output position in microseconds, which FFmpeg
+    reports even when stream-copying (it prints no frame count then).
+    """
+    proc = subprocess.Popen(
+        _with_progress(cmd),
+        stdin=subprocess.PIPE if input_text is not None else subprocess.DEVNULL,
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True
+    )
+    timed_out = threading.Event()
+
+    def _kill():
+        timed_out.set()
+        proc.kill()
+
+    watchdog = threading.Timer(timeout, _kill)
+    watchdog.start()
+    try:
+        if input_text is not None:
+            try:
+                proc.stdin.write(input_text)
+                proc.stdin.close()
+            except BrokenPipeError:
+                # FFmpeg exited early (e.g. bad input); its return code says why.
+                pass
+        for line in proc.stdout:
+            out_time_us = _parse_progress_value(line, 'out_time_us')
+            if out_time_us is not None and on_out_time:
+                on_out_time(out_time_us)
+    finally:
+        watchdog.cancel()
+        if proc.poll() is None:
+            proc.kill()
+        returncode = proc.wait()
+        for pipe in (proc.stdin, proc.stdout):
+            if pipe:
+                try:
+                    pipe.close()
+                except OSError:
+                    pass
+
+    if timed_out.is_set():
+        raise Exception(f"FFmpeg timed out after {timeout:.0f}s")
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd)
+
+async def _watch_progress(proc, on_frames: Optional[Callable[[int], None]]) -> int:
+    async for raw in proc.stdout:
+        frame = _parse_progress_value(raw.decode('utf-8', errors='replace'), 'frame')
+        if frame is not None and on_frames:
+            on_frames(frame)
+    return await proc.wait()
+
+async def _encode_segment(
+    args,
+    limit: asyncio.Semaphore,
+    on_frames: Optional[Callable[[int], None]] = None
+) -> str:
+    """
+    Encodes a single still-image segment. Frame counts are passed to
+    on_frames, which may update progress shared with the other segments.
+    Returns the segment path; raises if FFmpeg fails or times out.
+    """
+    segment_path, num_frames, fps = args[1], args[2], args[5]
+    cmd = _build_segment_cmd(args)
+    timeout = max(60, num_frames / fps * 10)
+
+    async with limit:
+        proc = await asyncio.create_subprocess_exec(
+            *_with_progress(cmd),
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+        try:
+            try:
+                returncode = await asyncio.wait_for(_watch_progress(proc, on_frames), timeout)
+            except asyncio.TimeoutError:
+                raise Exception(f"Error creating segment {segment_path}: FFmpeg timed out after {timeout:.0f}s")
+            if returncode != 0:
+                raise Exception(f"Error creating segment {segment_path}: FFmpeg exited with code {returncode}")
+            return segment_path
+        finally:
+            # Also covers cancellation when another segment failed.
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+
+async def _encode_all_segments(
+    tasks: list,
+    max_workers: int,
+    progress_callback: Optional[Callable[[str, int, int], None]] = None
+) -> List[str]:
+    """
+    Runs all segment encodes concurrently, at most max_workers at a time.
+    Reports ("segments", frames_done, frames_total) to progress_callback.
+    If any segment fails, the rest are cancelled and the error is raised,
+    since a missing segment would throw the video out of sync with the voice.
+    """
+    limit = asyncio.Semaphore(max_workers)
+    total_frames = sum(t[2] for t in tasks)
+    frames_done = [0] * len(tasks)
+
+    def _tracker(k: int) -> Optional[Callable[[int], None]]:
+        if not progress_callback:
+            return None
+        def _on_frames(frame: int) -> None:
+            frames_done[k] = frame
+            progress_callback("segments", sum(frames_done), total_frames)
+        return _on_frames
+
+    jobs = [asyncio.ensure_future(_encode_segment(t, limit, _tracker(k))) for k, t in enumerate(tasks)]
+    try:
+        return list(await asyncio.gather(*jobs))
+    except BaseException:
+        for job in jobs:
+            job.cancel()
+        await asyncio.gather(*jobs, return_exceptions=True)
+        raise
+
+def _prefetch_files(paths: List[str]) -> None:
+    """
+    Asks the kernel to start reading the files into the page cache, so the
+    concat stage doesn't stall on each open(). No-op where unsupported.
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+        except OSError:
+            pass
+
+def _estimate_scratch_bytes(total_duration_sec: float, num_images: int) -> int:
+    """Upper bound on the temp-folder size for a job."""
+    segment_bytes = total_duration_sec * SCRATCH_SEGMENT_BITRATE / 8
+    return int((segment_bytes + num_images * SCRATCH_BYTES_PER_IMAGE) * SCRATCH_HEADROOM)
+
+def _scratch_root(required_bytes: int) -> str:
+    """
+    Returns /dev/shm when it exists and has room for required_bytes, so the
+    intermediate segments never touch the disk. Falls back to OUTPUT_DIR.
+    """
+    try:
+        if os.path.isdir(SCRATCH_RAMDISK) and shutil.disk_usage(SCRATCH_RAMDISK).free >= required_bytes:
+            return SCRATCH_RAMDISK
+    except OSError:
+        pass
+    return OUTPUT_DIR
+
 def create_video_from_prompts(
     prompt_image_map: Dict[int, List[str]], 
     voice_file_path: str,
     job_id: str,
     target_duration_minutes: Optional[float] = None,
-    scene_texts_for_caption: List[str] = []
+    scene_texts_for_caption: List[str] = [],
+    progress_callback: Optional[Callable[[str, int, int], None]] = None
 ) -> str:
     """
     Creates the final video with stable Zoom/Pan effects and synced Captions.
+    progress_callback(stage, done, total) is called as FFmpeg reports
+    progress. For stage "segments" done/total count frames; for "final"
+    they are microseconds of output against the target duration.
     """
     
     if target_duration_minutes:
@@ -149,120 +654,96 @@ def create_video_from_prompts(
         raise Exception("No prompts with images found (Check image filenames).")
 
     duration_per_prompt = total_duration_sec / num_prompts
+
+    # --- Scratch space for segments (RAM-backed where possible) ---
+    # Only the final video is written to OUTPUT_DIR; the rest is removed
+    # with the temp folder.
+    final_output_path = os.path.join(OUTPUT_DIR, f"final_video_{job_id}.mp4")
+    unique_images = list(dict.fromkeys(p for imgs in prompt_image_map.values() for p in imgs))
+    scratch_root = _scratch_root(_estimate_scratch_bytes(total_duration_sec, len(unique_images)))
+    with tempfile.TemporaryDirectory(dir=scratch_root, prefix=f"{job_id}_") as tmpdir:
+        # --- Pre-scale every image once, so segments only zoom/pan ---
+        scaled_paths = [os.path.join(tmpdir, f"img_{k}.png") for k in range(len(unique_images))]
+        scaled_images = {}
+        if unique_images:
+            max_workers = _half_cores(len(unique_images))
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                scaled_images = dict(zip(unique_images, executor.map(_prescale_image, unique_images, scaled_paths)))
+
+        tasks = []
     
-    video_segments = []
-    segment_list_file = os.path.join(OUTPUT_DIR, f"segments_{job_id}.txt")
-    segment_file_paths = [] 
-    
-    for i, prompt_num in enumerate(sorted(prompt_image_map.keys())):
-        images = prompt_image_map[prompt_num]
-        if not images: continue
+        for i, prompt_num in enumerate(sorted(prompt_image_map.keys())):
+            images = prompt_image_map[prompt_num]
+            if not images: continue
             
-        num_images_in_prompt = len(images)
-        if num_images_in_prompt == 0: continue
+            num_images_in_prompt = len(images)
+            if num_images_in_prompt == 0: continue
             
-        duration_per_image = max(0.5, duration_per_prompt / num_images_in_prompt)
+            duration_per_image = max(0.5, duration_per_prompt / num_images_in_prompt)
         
-        # --- Caption preparation ---
-        current_scene_text = ""
-        if (prompt_num - 1) < len(scene_texts_for_caption):
-            current_scene_text = scene_texts_for_caption[prompt_num - 1]
+            # --- Caption preparation ---
+            current_scene_text = ""
+            if (prompt_num - 1) < len(scene_texts_for_caption):
+                current_scene_text = scene_texts_for_caption[prompt_num - 1]
         
-        wrapped_text = "\n".join(wrap(current_scene_text, 40))
-        caption_text = wrapped_text.replace("'", "'\\''").replace(":", "\:")
+            wrapped_text = "\n".join(wrap(current_scene_text, 40))
+            caption_png = _render_caption_png(wrapped_text, FONT_FILE, os.path.join(tmpdir, f"caption_{i}.png"))
         
-        for j, img_path in enumerate(images):
-            segment_path = os.path.join(OUTPUT_DIR, f"{job_id}_seg_{i}_{j}.mp4")
+            for j, img_path in enumerate(images):
+                segment_path = os.path.join(tmpdir, f"seg_{i}_{j}.mp4")
             
-            fps = 30
-            zoom_duration_frames = int(duration_per_image * fps) + 1
+                fps = 30
+                zoom_duration_frames = int(duration_per_image * fps) + 1
             
-            # --- STABLE ZOOM/PAN LOGIC (3-part Cycle) ---
-            effect_cycle = (i * num_images_in_prompt + j) % 3
-
-            if effect_cycle == 0: # 1st Pic: Zoom In (Focus Center)
-                zoom_dir = "min(1.5,zoom+0.0025)"
-                pan_x = "iw/2-(iw/zoom/2)"
-                pan_y = "ih/2-(ih/zoom/2)"
-            elif effect_cycle == 1: # 2nd Pic: Zoom Out (Focus Center)
-                zoom_dir = f"max(1.0, 1.4 - 0.4*on/{zoom_duration_frames})"
-                pan_x = "iw/2-(iw/zoom/2)"
-                pan_y = "ih/2-(ih/zoom/2)"
-            else: # 3rd Pic: Pan Left to Right (Stable Zoom)
-                zoom_dir = "1.1" # Fixed slight zoom
-                pan_x = f"if(eq(on,0), 0, x+((iw/zoom)/{zoom_duration_frames}/2))"
-                pan_y = "y"
-
-            vf_complex = (
-                f"scale=1920:1080:force_original_aspect_ratio=decrease,"
-                f"pad=1920:1080:(ow-iw)/2:(oh-ih)/2:color=black,"
-                f"zoompan=z='{zoom_dir}':x='{pan_x}':y='{pan_y}':"
-                f"d={zoom_duration_frames}:s=1920x1080:fps={fps}"
-            )
-            
-            # --- CAPTION FIX: Removed alpha animation for stability ---
-            font_path_for_ffmpeg = FONT_FILE.replace(":", "\\:")
-            
-            vf_text_overlay = (
-                f"drawtext=fontfile='{font_path_for_ffmpeg}':text='{caption_text}':"
-                f"fontcolor=white:fontsize=60:x=(w-text_w)/2:y=h-th-50:"
-                f"box=1:boxcolor=black@0.5:boxborderw=10"
-            )
-
-            cmd = [
-                FFMPEG_PATH, '-y',
-                '-loop', '1', '-i', img_path,
-                '-c:v', 'libx264',
-                '-pix_fmt', 'yuv420p',
-                '-t', str(duration_per_image),
-                '-vf', f"{vf_complex},{vf_text_overlay}",
-                '-r', str(fps),
-                segment_path
-            ]
-            
-            try:
-                subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                video_segments.append(segment_path)
-                segment_file_paths.append(os.path.abspath(segment_path).replace(os.sep, '/'))
-            except Exception as e:
-                print(f"Error creating segment {segment_path}: {e}")
+                # --- STABLE ZOOM/PAN LOGIC (3-part Cycle) ---
+                effect_cycle = (i * num_images_in_prompt + j) % 3
+                vf_complex = _zoompan_filter(effect_cycle, zoom_duration_frames, fps)
 
-    try:
-        with open(segment_list_file, 'w') as f:
-            for path in segment_file_paths:
-                f.write(f"file '{path}'\n")
-    except Exception as e:
-        raise Exception(f"Error writing segment list file: {e}")
+                scaled_img_path = scaled_images.get(img_path, img_path)
+                if scaled_img_path == img_path:
+                    # Pre-scale failed; scale/pad here so zoompan keeps the aspect ratio.
+                    vf_complex = (
+                        f"scale=1920:1080:force_original_aspect_ratio=decrease,"
+                        f"pad=1920:1080:(ow-iw)/2:(oh-ih)/2:color=black,"
+                        f"{vf_complex}"
+                    )
 
-    concatenated_video_path = os.path.join(OUTPUT_DIR, f"video_no_audio_{job_id}.mp4")
-    cmd_concat = [
-        FFMPEG_PATH, '-y',
-        '-f', 'concat',
-        '-safe', '0',
-        '-i', segment_list_file,
-        '-c', 'copy',
-        concatenated_video_path
-    ]
-    subprocess.run(cmd_concat, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                tasks.append((scaled_img_path, segment_path, zoom_duration_frames, vf_complex, caption_png, fps))
 
-    final_output_path = os.path.join(OUTPUT_DIR, f"final_video_{job_id}.mp4")
-    cmd_add_audio = [
-        FFMPEG_PATH, '-y',
-        '-i', concatenated_video_path,
-        '-i', voice_file_path,
-        '-c:v', 'copy',
-        '-c:a', 'aac',
-        '-shortest',
-        final_output_path
-    ]
-    subprocess.run(cmd_add_audio, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        # --- Encode segments in parallel (order preserved by asyncio.gather) ---
+        video_segments = []
+        if tasks:
+            max_workers = _half_cores(len(tasks))
+            video_segments = asyncio.run(_encode_all_segments(tasks, max_workers, progress_callback))
 
-    try:
-        os.remove(segment_list_file)
-        os.remove(concatenated_video_path)
-        for seg in video_segments:
-            os.remove(seg)
-    except Exception as e:
-        print(f"Warning: Could not clean up temp files: {e}")
+        _prefetch_files(video_segments)
+
+        segment_file_paths = [os.path.abspath(p).replace(os.sep, '/') for p in video_segments]
+        # Entries need an explicit 'file:' protocol, or FFmpeg resolves them
+        # relative to the 'pipe:' URL the list itself is read from.
+        segment_list = "".join(f"file 'file:{path}'\n" for path in segment_file_paths)
+
+        # --- Concat + audio mux in a single pass (no intermediate no-audio MP4) ---
+        # The concat list is streamed over stdin rather than written to disk.
+        cmd_final = [
+            FFMPEG_PATH, '-y',
+            '-fflags', '+genpts',
+            '-f', 'concat',
+            '-safe', '0',
+            '-protocol_whitelist', 'file,pipe',
+            '-i', 'pipe:0',
+            '-i', voice_file_path,
+            '-map', '0:v:0',
+            '-map', '1:a:0',
+            '-c:v', 'copy',
+            '-c:a', 'aac',
+            '-shortest',
+            final_output_path
+        ]
+        total_us = int(total_duration_sec * 1_000_000)
+        on_out_time = None
+        if progress_callback:
+            on_out_time = lambda out_time_us: progress_callback("final", out_time_us, total_us)
+        _run_ffmpeg(cmd_final, timeout=max(60, total_duration_sec * 2), on_out_time=on_out_time, input_text=segment_list)
 
     return final_output_path
\ No newline at end of file
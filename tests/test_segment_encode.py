@@ -0,0 +1,76 @@
+"""
+End-to-end encode check for the zoom/pan segments. Needs a working FFmpeg
+on PATH (or ffmpeg.exe next to storypilot_core.py); skipped otherwise.
+"""
+
+import shutil
+import subprocess
+
+import pytest
+
+storypilot_core = pytest.importorskip("storypilot_core")
+from PIL import Image, ImageChops, ImageDraw, ImageStat
+
+if not shutil.which(storypilot_core.FFMPEG_PATH):
+    pytest.skip("FFmpeg not available", allow_module_level=True)
+
+FPS = 30
+THUMB = (480, 270)
+
+
+def _grid_image(path):
+    img = Image.new("RGB", (1920, 1080), "white")
+    draw = ImageDraw.Draw(img)
+    for x in range(0, 1920, 120):
+        draw.line([(x, 0), (x, 1079)], fill="black", width=6)
+    for y in range(0, 1080, 120):
+        draw.line([(0, y), (1919, y)], fill="black", width=6)
+    img.save(path)
+    return img
+
+
+def _zoomed(img, zoom):
+    """Reference frame: centre crop at 'zoom', scaled back to full size."""
+    w, h = 1920 / zoom, 1080 / zoom
+    x, y = (1920 - w) / 2, (1080 - h) / 2
+    return img.crop((x, y, x + w, y + h)).resize(THUMB, Image.BILINEAR).convert("L")
+
+
+def _decode_frames(video_path):
+    raw = subprocess.run(
+        [storypilot_core.FFMPEG_PATH, "-v", "error", "-i", video_path,
+         "-vf", f"scale={THUMB[0]}:{THUMB[1]}", "-pix_fmt", "gray", "-f", "rawvideo", "-"],
+        stdout=subprocess.PIPE, check=True
+    ).stdout
+    size = THUMB[0] * THUMB[1]
+    return [Image.frombytes("L", THUMB, raw[i:i + size]) for i in range(0, len(raw), size)]
+
+
+def _mean_abs_diff(a, b):
+    return ImageStat.Stat(ImageChops.difference(a, b)).mean[0]
+
+
+def test_zoom_in_segment_first_and_last_frames(tmp_path, monkeypatch):
+    monkeypatch.setattr(storypilot_core, "OUTPUT_DIR", str(tmp_path))
+    grid = _grid_image(str(tmp_path / "1.png"))
+    voice = str(tmp_path / "voice.wav")
+    subprocess.run(
+        [storypilot_core.FFMPEG_PATH, "-v", "error", "-y", "-f", "lavfi",
+         "-i", "anullsrc=r=44100:cl=mono", "-t", "3", voice],
+        check=True
+    )
+
+    # One prompt with one image gets effect 0 (zoom in) for 2 seconds.
+    video = storypilot_core.create_video_from_prompts(
+        {1: [str(tmp_path / "1.png")]}, voice, "test", target_duration_minutes=2 / 60
+    )
+    frames = _decode_frames(video)
+    assert len(frames) == 2 * FPS + 1
+
+    first, last = frames[0], frames[-1]
+    last_zoom = 1 + 0.0025 * len(frames)
+    # Each frame matches its expected zoom far better than the other one,
+    # so the image really zooms in and is not sheared or garbled.
+    assert _mean_abs_diff(first, _zoomed(grid, 1.0025)) < 15
+    assert _mean_abs_diff(last, _zoomed(grid, last_zoom)) < 15
+    assert _mean_abs_diff(last, _zoomed(grid, 1.0025)) > 2 * _mean_abs_diff(last, _zoomed(grid, last_zoom))